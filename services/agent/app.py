@@ -6,15 +6,20 @@ Denne agenten kobler OpenAI GPT med MCP server som kjører som separat tjeneste.
 """
 
 import asyncio
+import hashlib
 import json
 import logging
 import os
+import re
+import time
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Callable, Optional, Tuple
 
 import httpx
-from openai import OpenAI
+import orjson
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from conversation_memory import ConversationMemory
+from response_cache import TTLCache
 
 # Konfigurer logging
 logging.basicConfig(level=logging.INFO)
@@ -23,6 +28,135 @@ logger = logging.getLogger(__name__)
 # Global agent instance for API server
 agent_instance = None
 
+# Konfigurasjon fra miljøvariabler - leses én gang ved oppstart
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+MCP_SERVER_URL = os.getenv("MCP_SERVER_URL", "http://mcp-server:8000")
+
+# Språkmodell som brukes for alle AI-kall
+MODEL = "gpt-4o-mini"
+
+# Maks antall samtaleturer som lagres i én transaksjon
+MEMORY_WRITE_BATCH = 64
+
+# Maks antall tokens med samtalehistorikk per AI-kall; eldre meldinger oppsummeres.
+# Når budsjettet sprenges, oppsummeres historikken ned til HISTORY_SUMMARY_TARGET,
+# så det går flere turer før neste oppsummering trengs.
+HISTORY_TOKEN_BUDGET = 3000
+HISTORY_SUMMARY_TARGET = HISTORY_TOKEN_BUDGET // 2
+
+# Maks antall meldinger per oppsummeringskall; resten tas i neste tur
+SUMMARY_MAX_MESSAGES = 100
+
+SUMMARY_PROMPT = """Oppsummer samtalen mellom en bruker og reiseagenten Ingrid kort på norsk.
+Ta med destinasjoner, datoer, preferanser og andre fakta brukeren har nevnt.
+Bygg videre på et eventuelt tidligere sammendrag."""
+
+# Hvor lenge et identisk AI-kall kan besvares fra cache (sekunder)
+RESPONSE_CACHE_TTL = 3600
+
+# Maks samtidige AI-kall (strømming og sammendrag) fra agenten
+OPENAI_MAX_CONCURRENT_REQUESTS = 10
+
+# Maks samtidige HTTP-tilkoblinger til MCP server
+MCP_MAX_CONNECTIONS = 20
+MCP_KEEPALIVE_EXPIRY = 30.0
+
+# Tidsgrenser mot MCP server. Lesegrensen dekker MCP-serverens egne nye forsøk
+# mot eksterne API-er; pool-grensen gjør at en full pool feiler raskt.
+MCP_TIMEOUT = httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=5.0)
+
+# Maks antall runder med verktøykall per spørsmål, før et avsluttende svar uten tools
+MAX_TOOL_ROUNDS = 5
+
+# Minste tid mellom nye forsøk på å hente tools hvis MCP server var utilgjengelig (sekunder)
+TOOLS_RETRY_INTERVAL = 30
+
+# Hvor lenge vellykkede verktøyresultater gjenbrukes (sekunder)
+TOOL_CACHE_TTL = 300
+
+# Feilresultater gjenbrukes kort, så en MCP server med problemer ikke får
+# samme kall igjen og igjen
+TOOL_ERROR_CACHE_TTL = 30
+
+# Verktøy og byer for spekulativ forhåndshenting: byer som nevnes i en samtale
+# får værdata hentet i bakgrunnen mens brukeren skriver neste spørsmål
+PREFETCH_TOOL = "get_weather_forecast"
+PREFETCH_LIMIT = 3
+PREFETCH_CITIES = (
+    "Oslo", "Bergen", "Trondheim", "Stavanger", "Tromsø", "Kristiansand", "Drammen",
+    "Fredrikstad", "Bodø", "Ålesund", "Lillehammer", "Hamar", "Tønsberg", "Sandefjord",
+    "Arendal", "Haugesund", "Molde", "Narvik", "Alta", "Hammerfest", "Kirkenes",
+    "Svolvær", "Lofoten", "Røros", "Geiranger", "Flåm", "Longyearbyen",
+    "København", "Stockholm", "Göteborg", "Helsingfors", "Reykjavik"
+)
+_CITY_RE = re.compile(r"\b(" + "|".join(PREFETCH_CITIES) + r")\b", re.IGNORECASE)
+_CITY_NAMES = {city.lower(): city for city in PREFETCH_CITIES}
+
+# Enkle værspørsmål om en kjent by ("vær i Oslo i morgen") besvares uten at
+# modellen først må velge verktøy: verktøyet kalles direkte og modellen
+# formulerer bare et kort svar
+_DIRECT_WEATHER_RE = re.compile(
+    r"^\s*(?:hva er |hvordan er |hvordan blir )?(?:været|vær|værmelding|værvarsel|forecast)"
+    r"\s+(?:i|for|på)\s+(?P<city>" + "|".join(PREFETCH_CITIES) + r")"
+    r"(?:\s+(?:i dag|i morgen|i helgen|denne uken|neste uke))?\s*[?.!]*\s*$",
+    re.IGNORECASE
+)
+DIRECT_ANSWER_MAX_TOKENS = 300
+
+# Systemprompt - holdes statisk og først i meldingslisten slik at OpenAI kan
+# gjenbruke det cachede prefikset. Dynamisk innhold hører hjemme i brukermeldingen.
+SYSTEM_PROMPT = """Du er Ingrid, en vennlig og kompetent agent fra Ingrids Reisetjenester. 
+
+Du har kun lov å bruke verktøyene for å hente værinformasjon i hele verden. Hvis brukeren spør om noe annet enn vær, skal forespørselen avvises på en hyggelig måte.
+
+Når brukeren spør om flere uavhengige ting (f.eks. vær i flere byer), kall alle relevante verktøy i samme svar slik at de kjører parallelt. Bruk sekvensielle kall bare når et senere kall avhenger av resultatet av et tidligere.
+
+Utover det, vær vennlig, personlig og hjelpsom - du representerer Ingrids Reisetjenester.
+Svar på norsk med mindre brukeren spør på et annet språk.
+
+MERK: Dette er LAB02 versjon med dynamisk tools discovery."""
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.encoding_for_model(MODEL)
+except Exception:  # tiktoken mangler eller encoding kan ikke lastes
+    _ENCODING = None
+
+def count_tokens(text: str) -> int:
+    """Tell tokens i en tekst, med et grovt estimat hvis tiktoken ikke er tilgjengelig."""
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    return len(text) // 4 + 1
+
+def create_openai_client() -> AsyncOpenAI:
+    """Lag OpenAI klient med egen tilkoblingspool med HTTP/2, slik at samtidige AI-kall deler tilkoblinger."""
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        base_url="https://models.github.ai/inference",
+        http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=OPENAI_MAX_CONCURRENT_REQUESTS,
+                                max_keepalive_connections=OPENAI_MAX_CONCURRENT_REQUESTS)
+        )
+    )
+
+def create_mcp_http_client() -> httpx.AsyncClient:
+    """
+    Lag HTTP klient for MCP kall.
+    
+    Parallelle verktøykall og forhåndshenting kjører samtidig på hver sin
+    keep-alive tilkobling fra poolen, så poolen må ha plass til dem uten at
+    kall blir stående i kø bak hverandre. Tilkoblingsfeil (f.eks. mens MCP
+    server starter) prøves én gang til.
+    """
+    return httpx.AsyncClient(
+        timeout=MCP_TIMEOUT,
+        limits=httpx.Limits(max_connections=MCP_MAX_CONNECTIONS,
+                            max_keepalive_connections=MCP_MAX_CONNECTIONS,
+                            keepalive_expiry=MCP_KEEPALIVE_EXPIRY),
+        transport=httpx.AsyncHTTPTransport(retries=1)
+    )
+
 class MicroserviceAgent:
     """
     AI Agent som bruker MCP server via HTTP API.
@@ -33,26 +167,71 @@ class MicroserviceAgent:
     3. Administrerer samtalehukommelse
     """
     
-    def __init__(self, mcp_server_url: str = None, memory_db_path: str = "/data/conversations.db"):
+    def __init__(self, mcp_server_url: str = None, memory_db_path: Optional[str] = "/data/conversations.db",
+                 openai_client: Optional[AsyncOpenAI] = None, http_client: Optional[httpx.AsyncClient] = None):
+        """
+        Args:
+            mcp_server_url: URL til MCP server, ellers MCP_SERVER_URL
+            memory_db_path: Sti til samtaledatabasen, eller None for ingen hukommelse
+            openai_client: Delt OpenAI klient; ellers lager og lukker agenten sin egen
+            http_client: Delt HTTP klient for MCP kall; ellers lager og lukker agenten sin egen
+        """
+        # Klienter agenten lager selv, lukkes av close(); delte klienter lukkes av eieren
+        self._owned_client_closers = []
+        
         # Initialiser OpenAI klient
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"),base_url="https://models.github.ai/inference")
+        if openai_client is None:
+            openai_client = create_openai_client()
+            self._owned_client_closers.append(openai_client.close)
+        self.client = openai_client
+        
+        # Tak på samtidige AI-kall, slik at en trafikktopp ikke gir en flom av kall
+        self._llm_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENT_REQUESTS)
         
         # MCP server URL - bruk environment variable hvis tilgjengelig
-        if mcp_server_url is None:
-            mcp_server_url = os.getenv("MCP_SERVER_URL", "http://mcp-server:8000")
-        self.mcp_server_url = mcp_server_url
+        self.mcp_server_url = mcp_server_url or MCP_SERVER_URL
         
-        # Initialiser hukommelse
-        self.memory = ConversationMemory(memory_db_path)
+        # Initialiser hukommelse - memory_db_path=None gir en agent uten persistent historikk
+        self.memory = ConversationMemory(memory_db_path) if memory_db_path else None
         self.current_session_id = None
         
+        # Sammendrag av meldinger som ikke får plass i token-budsjettet, per sesjon
+        # Id til siste oppsummerte melding per sesjon; eldre meldinger leses ikke
+        self._summaries: Dict[str, str] = {}
+        self._summary_markers: Dict[str, int] = {}
+        self._summary_tasks: Dict[str, asyncio.Task] = {}
+        
         # HTTP klient for MCP kall
-        self.http_client = httpx.AsyncClient()
+        if http_client is None:
+            http_client = create_mcp_http_client()
+            self._owned_client_closers.append(http_client.aclose)
+        self.http_client = http_client
+        
+        # Cache for AI-svar på identiske forespørsler (samme modell, meldinger og tools).
+        # Ingen av kallene setter temperature, så et cachet svar er like gyldig som et nytt.
+        self.response_cache = TTLCache(default_ttl=RESPONSE_CACHE_TTL)
+        self.stats = self.response_cache.stats
+        
+        # Cache for verktøyresultater, fylles av vanlige kall og forhåndshenting
+        self.tool_cache = TTLCache(default_ttl=TOOL_CACHE_TTL, max_entries=128)
+        self._inflight_tool_calls: Dict[str, asyncio.Task] = {}
+        self._prefetch_tasks = set()
+        
+        # Skriveoppgaven for hukommelsen og turene den ikke har lagret ennå
+        self._memory_write: Optional[asyncio.Task] = None
+        self._pending_turns: List[Tuple[str, List[Dict[str, Any]]]] = []
         
         # Tools vil bli hentet dynamisk fra MCP server
         self.tools = []
         # Tool endpoint mapping lagres separat
         self.tool_endpoints = {}
+        # Navn på kjente tools for rask validering av verktøykall
+        self._tool_names = frozenset()
+        # Hash av tools-listen, brukt i cache-nøkler i stedet for å serialisere listen per kall
+        self._tools_digest = self._digest_tools(self.tools)
+        # Beskytter connect() mot samtidige forsøk
+        self._connect_lock = asyncio.Lock()
+        self._last_connect_attempt = 0.0
         
         logger.info("MicroserviceAgent initialisert")
     
@@ -76,26 +255,31 @@ class MicroserviceAgent:
             converted_tools = []
             tool_endpoints = {}
             
-            for tool in tools_list:
+            # Sorter tools og schema-nøkler slik at tools-listen blir byte-identisk
+            # mellom kall uavhengig av rekkefølgen MCP server leverer dem i
+            for tool in sorted(tools_list, key=lambda t: t["name"]):
                 openai_tool = {
                     "type": "function",
                     "function": {
                         "name": tool["name"],
                         "description": tool["description"],
-                        "parameters": tool["inputSchema"]
+                        "parameters": json.loads(json.dumps(tool["inputSchema"], sort_keys=True))
                     }
                 }
                 converted_tools.append(openai_tool)
                 
-                # Lagre endpoint-informasjon
+                # Lagre endpoint-informasjon med ferdig URL og normalisert metode
                 if "endpoint" in tool:
                     tool_endpoints[tool["name"]] = {
                         "endpoint": tool["endpoint"],
-                        "method": tool.get("method", "POST")
+                        "method": tool.get("method", "POST").upper(),
+                        "url": f"{self.mcp_server_url}{tool['endpoint']}"
                     }
             
             self.tools = converted_tools
             self.tool_endpoints = tool_endpoints
+            self._tool_names = frozenset(tool["function"]["name"] for tool in converted_tools)
+            self._tools_digest = self._digest_tools(converted_tools)
             logger.info(f"Lastet {len(self.tools)} tools fra MCP server med {len(self.tool_endpoints)} endpoint mappings")
             return True
             
@@ -124,145 +308,517 @@ class MicroserviceAgent:
         # Convert underscores to hyphens for REST convention
         return f"/{tool_name.replace('_', '-')}"
     
+    @staticmethod
+    def _tool_cache_key(tool_name: str, arguments: Dict[str, Any]) -> str:
+        """Lag cache-nøkkel for et verktøykall; tekstargumenter normaliseres."""
+        normalized = {
+            key: value.strip().lower() if isinstance(value, str) else value
+            for key, value in arguments.items()
+        }
+        return orjson.dumps([tool_name, normalized], option=orjson.OPT_SORT_KEYS).decode()
+    
     async def call_mcp_tool(self, tool_name: str, arguments: Dict[str, Any]) -> str:
         """
         Kall MCP server via HTTP basert på endpoint info fra tools manifest.
         Bruker eksplisitt endpoint-mapping hvis tilgjengelig, ellers fallback til konvensjon.
+        Vellykkede resultater caches en kort stund, feilresultater enda kortere.
         """
+        # Avvis ukjente (f.eks. hallusinerte) verktøynavn uten å gå via MCP server
+        if self._tool_names and tool_name not in self._tool_names:
+            logger.warning(f"Ukjent verktøy forespurt: {tool_name}")
+            return json.dumps({"error": f"Ukjent verktøy: {tool_name}"})
+        
+        cache_key = self._tool_cache_key(tool_name, arguments)
+        cached = self.tool_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Verktøyresultat for %s hentet fra cache", tool_name)
+            return cached
+        
+        # Samtidige kall med samme argumenter (f.eks. forhåndshenting og et
+        # spørsmål om samme by) deler ett kall mot MCP server
+        task = self._inflight_tool_calls.get(cache_key)
+        if task is None:
+            task = asyncio.create_task(self._fetch_tool_result(tool_name, arguments, cache_key))
+            self._inflight_tool_calls[cache_key] = task
+            task.add_done_callback(lambda _: self._inflight_tool_calls.pop(cache_key, None))
+        
+        # shield: et avbrutt kall skal ikke avbryte kallet de andre venter på
+        return await asyncio.shield(task)
+    
+    async def _fetch_tool_result(self, tool_name: str, arguments: Dict[str, Any], cache_key: str) -> str:
+        """Hent verktøyresultat fra MCP server og cache det; feil caches kortere."""
         try:
-            logger.info(f"Kaller MCP server: {tool_name} med args: {arguments}")
+            result = await self._request_mcp_tool(tool_name, arguments)
             
-            # PRIORITET 1: Bruk eksplisitt endpoint info fra MCP server tools manifest
-            if tool_name in self.tool_endpoints:
-                endpoint_info = self.tool_endpoints[tool_name]
-                endpoint = endpoint_info["endpoint"]
-                method = endpoint_info.get("method", "POST")
-                logger.info(f"Bruker dynamisk endpoint mapping fra MCP server: {tool_name} -> {method} {endpoint}")
+            if result.get("success"):
+                data = result["data"]
+                tool_result = orjson.dumps(data).decode()
+                failed = isinstance(data, dict) and "error" in data
             else:
-                # PRIORITET 2: Fallback til konvensjonbasert mapping (kun hvis MCP server ikke gir endpoint info)
-                endpoint = self._map_tool_to_endpoint(tool_name)
-                method = "POST"
-                logger.warning(f"Ingen eksplisitt endpoint fra MCP server for {tool_name}, bruker fallback: {endpoint}")
-            
-            # Gjør HTTP kall til MCP server
+                tool_result = json.dumps({"error": result.get("error", "Unknown error")})
+                failed = True
+                
+        except Exception as e:
+            logger.error(f"MCP tool call failed: {e}")
+            tool_result = json.dumps({"error": str(e)})
+            failed = True
+        
+        self.tool_cache.set(cache_key, tool_result, ttl=TOOL_ERROR_CACHE_TTL if failed else None)
+        return tool_result
+    
+    async def _request_mcp_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        """Gjør selve HTTP-kallet til MCP server og returner JSON-svaret."""
+        logger.debug("Kaller MCP server: %s med args: %s", tool_name, arguments)
+        
+        # PRIORITET 1: Bruk eksplisitt endpoint info fra MCP server tools manifest
+        endpoint_info = self.tool_endpoints.get(tool_name)
+        if endpoint_info:
+            url = endpoint_info["url"]
+            method = endpoint_info["method"]
+            logger.debug("Bruker dynamisk endpoint mapping fra MCP server: %s -> %s %s",
+                         tool_name, method, endpoint_info["endpoint"])
+        else:
+            # PRIORITET 2: Fallback til konvensjonbasert mapping (kun hvis MCP server ikke gir endpoint info)
+            endpoint = self._map_tool_to_endpoint(tool_name)
             url = f"{self.mcp_server_url}{endpoint}"
+            method = "POST"
+            logger.warning("Ingen eksplisitt endpoint fra MCP server for %s, bruker fallback: %s", tool_name, endpoint)
+        
+        # Gjør HTTP kall til MCP server - støtt forskjellige HTTP metoder
+        if method == "GET":
+            response = await self.http_client.get(url, params=arguments)
+        elif method == "POST":
+            response = await self.http_client.post(url, json=arguments)
+        elif method == "PUT":
+            response = await self.http_client.put(url, json=arguments)
+        elif method == "DELETE":
+            response = await self.http_client.delete(url, params=arguments)
+        else:
+            raise ValueError(f"Unsupported HTTP method: {method}")
             
-            # Støtt forskjellige HTTP metoder
-            if method.upper() == "GET":
-                response = await self.http_client.get(url, params=arguments)
-            elif method.upper() == "POST":
-                response = await self.http_client.post(url, json=arguments)
-            elif method.upper() == "PUT":
-                response = await self.http_client.put(url, json=arguments)
-            elif method.upper() == "DELETE":
-                response = await self.http_client.delete(url, params=arguments)
-            else:
-                raise ValueError(f"Unsupported HTTP method: {method}")
-                
-            response.raise_for_status()
+        response.raise_for_status()
+        
+        return orjson.loads(response.content)
+    
+    def _prefetch_mentioned_cities(self, text: str):
+        """
+        Hent vær i bakgrunnen for kjente byer nevnt i teksten.
+        
+        Resultatene havner i tool_cache, slik at et oppfølgingsspørsmål om en
+        av byene kun venter på AI-kallet og ikke på MCP server.
+        """
+        if PREFETCH_TOOL not in self._tool_names:
+            return
+        
+        cities = dict.fromkeys(_CITY_NAMES[match.lower()] for match in _CITY_RE.findall(text))
+        for city in list(cities)[:PREFETCH_LIMIT]:
+            arguments = {"location": city}
+            if self.tool_cache.get(self._tool_cache_key(PREFETCH_TOOL, arguments)) is not None:
+                continue
             
-            result = response.json()
+            logger.debug("Forhåndshenter vær for %s", city)
+            task = asyncio.create_task(self.call_mcp_tool(PREFETCH_TOOL, arguments))
+            self._prefetch_tasks.add(task)
+            task.add_done_callback(self._prefetch_tasks.discard)
+    
+    async def _execute_tool_call(self, tool_call: Dict[str, Any]) -> str:
+        """
+        Utfør ett verktøykall fra OpenAI.
+        
+        Feil fanges og returneres som JSON slik at ett feilende kall ikke
+        avbryter de andre kallene som kjøres parallelt.
+        """
+        function = tool_call["function"]
+        try:
+            arguments = orjson.loads(function["arguments"] or "{}")
+        except json.JSONDecodeError as e:
+            logger.error(f"Ugyldige argumenter for {function['name']}: {e}")
+            return json.dumps({"error": f"Ugyldige argumenter: {str(e)}"})
+        
+        # Gyldig JSON er ikke nok - verktøyene tar navngitte argumenter
+        if not isinstance(arguments, dict):
+            logger.error(f"Ugyldige argumenter for {function['name']}: forventet objekt")
+            return json.dumps({"error": "Ugyldige argumenter: forventet objekt"})
+        
+        return await self.call_mcp_tool(function["name"], arguments)
+    
+    def _log_usage(self, usage) -> None:
+        """Logg hvor stor del av prompten som ble truffet i OpenAI sin prompt cache."""
+        if not usage or not usage.prompt_tokens:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        logger.debug("Prompt cache: %d/%d tokens (%.0f%%)", cached_tokens, usage.prompt_tokens,
+                     100 * cached_tokens / usage.prompt_tokens)
+    
+    @staticmethod
+    def _digest_tools(tools: List[Dict[str, Any]]) -> str:
+        """Hash av tools-listen slik den sendes til OpenAI."""
+        return hashlib.sha256(orjson.dumps(tools, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    
+    def _cache_key(self, messages: List[Dict[str, Any]], with_tools: bool = False) -> str:
+        """Lag cache-nøkkel for et AI-kall basert på alt som påvirker svaret."""
+        payload = orjson.dumps({"model": MODEL, "messages": messages,
+                                "tools": self._tools_digest if with_tools else None},
+                               option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(payload).hexdigest()
+    
+    async def _stream_completion(self, messages: List[Dict[str, Any]],
+                                 tools: Optional[List[Dict[str, Any]]] = None,
+                                 on_tool_call: Optional[Callable[[Dict[str, Any]], None]] = None,
+                                 on_token: Optional[Callable[[str], None]] = None,
+                                 max_tokens: Optional[int] = None
+                                 ) -> Tuple[str, List[Dict[str, Any]]]:
+        """
+        Strøm et AI-kall og sett sammen tekst og verktøykall.
+        
+        Tekst sendes til on_token etter hvert som den kommer. Hvert verktøykall
+        sendes til on_tool_call så snart det er ferdig generert (neste kall
+        starter eller strømmen slutter), slik at MCP-kallet kan kjøre mens
+        modellen fortsatt skriver resten av svaret.
+        """
+        cache_key = self._cache_key(messages, with_tools=tools is not None)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            content, tool_calls = cached
+            tool_calls = orjson.loads(orjson.dumps(tool_calls))
+            if on_token and content:
+                on_token(content)
+            if on_tool_call:
+                for tool_call in tool_calls:
+                    on_tool_call(tool_call)
+            logger.debug("AI-svar hentet fra cache")
+            return content, tool_calls
+        
+        tool_kwargs = {"tools": tools, "tool_choice": "auto"} if tools is not None else {}
+        if max_tokens is not None:
+            tool_kwargs["max_tokens"] = max_tokens
+        # Tekst og argumenter samles som lister og slås sammen til slutt
+        content_parts = []
+        tool_calls = []
+        argument_parts = []
+        
+        def finish_tool_call():
+            tool_calls[-1]["function"]["arguments"] = "".join(argument_parts[-1])
+            if on_tool_call:
+                on_tool_call(tool_calls[-1])
+        
+        # Plassen holdes til strømmen er lest ferdig
+        async with self._llm_semaphore:
+            stream = await self.client.chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                **tool_kwargs
+            )
             
-            if result.get("success"):
-                return json.dumps(result["data"], ensure_ascii=False)
-            else:
-                return json.dumps({"error": result.get("error", "Unknown error")})
+            async for chunk in stream:
+                if not chunk.choices:
+                    # Siste chunk inneholder kun token-forbruk
+                    self._log_usage(chunk.usage)
+                    continue
+                delta = chunk.choices[0].delta
+                
+                if delta.content:
+                    content_parts.append(delta.content)
+                    if on_token:
+                        on_token(delta.content)
                 
+                for tc_delta in delta.tool_calls or []:
+                    if tc_delta.index >= len(tool_calls):
+                        # Et nytt kall betyr at det forrige er komplett
+                        if tool_calls:
+                            finish_tool_call()
+                        tool_calls.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+                        argument_parts.append([])
+                    
+                    current = tool_calls[tc_delta.index]
+                    if tc_delta.id:
+                        current["id"] = tc_delta.id
+                    if tc_delta.function:
+                        if tc_delta.function.name:
+                            current["function"]["name"] += tc_delta.function.name
+                        if tc_delta.function.arguments:
+                            argument_parts[tc_delta.index].append(tc_delta.function.arguments)
+        
+        if tool_calls:
+            finish_tool_call()
+        content = "".join(content_parts)
+        
+        # tool_calls endres ikke etter dette, så cachen kan dele listen;
+        # treff får sin egen kopi over
+        self.response_cache.set(cache_key, (content, tool_calls))
+        return content, tool_calls
+    
+    def _trim_history(self, history: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Del historikken i meldinger som får plass i token-budsjettet og meldinger
+        som skal oppsummeres.
+        
+        Nyeste meldinger prioriteres. Sprenges budsjettet, oppsummeres alt utover
+        HISTORY_SUMMARY_TARGET; noen av disse meldingene sendes også med denne
+        turen. Returnerer (beholdt, til oppsummering), begge i kronologisk rekkefølge.
+        """
+        used = 0
+        start = len(history)
+        summary_end = None
+        while start > 0:
+            # ~4 tokens overhead per melding for rolle og formatering
+            cost = count_tokens(history[start - 1]["content"] or "") + 4
+            if used + cost > HISTORY_TOKEN_BUDGET:
+                break
+            used += cost
+            if summary_end is None and used > HISTORY_SUMMARY_TARGET:
+                summary_end = start
+            start -= 1
+        if start == 0:
+            return history, []
+        return history[start:], history[:summary_end if summary_end is not None else start]
+    
+    def _schedule_summary(self, session_id: str, messages: List[Dict[str, Any]]):
+        """Start oppsummering av meldinger i bakgrunnen, hvis ingen allerede kjører."""
+        if session_id in self._summary_tasks:
+            return
+        
+        task = asyncio.create_task(self._summarize(session_id, messages[:SUMMARY_MAX_MESSAGES]))
+        self._summary_tasks[session_id] = task
+        task.add_done_callback(lambda _: self._summary_tasks.pop(session_id, None))
+    
+    async def _summarize(self, session_id: str, messages: List[Dict[str, Any]]):
+        """Legg meldinger som ikke lenger får plass i konteksten til sammendraget."""
+        try:
+            transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+            previous = self._summaries.get(session_id, "")
+            async with self._llm_semaphore:
+                response = await self.client.chat.completions.create(
+                    model=MODEL,
+                    messages=[
+                        {"role": "system", "content": SUMMARY_PROMPT},
+                        {"role": "user", "content": f"Tidligere sammendrag:\n{previous}\n\nMeldinger:\n{transcript}"}
+                    ],
+                    max_tokens=300
+                )
+            summary = response.choices[0].message.content
+            summary_until = messages[-1]["id"]
+            self._summaries[session_id] = summary
+            self._summary_markers[session_id] = summary_until
+            if self.memory:
+                # Lagres slik at sammendraget overlever omstart
+                await asyncio.to_thread(self.memory.set_session_summary, session_id, summary, summary_until)
+            logger.info(f"Samtalesammendrag oppdatert for {session_id}")
         except Exception as e:
-            logger.error(f"MCP tool call failed: {e}")
-            return json.dumps({"error": str(e)})
+            logger.error(f"Kunne ikke oppsummere samtale: {e}")
     
     def start_new_session(self, session_name: str = None):
         """Start en ny samtalesession."""
         if not session_name:
             session_name = f"Microservice_Session_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         
-        self.current_session_id = self.memory.create_session(session_name)
+        if self.memory:
+            self.current_session_id = self.memory.create_session(title=session_name)
+        else:
+            self.current_session_id = session_name
         logger.info(f"Ny session startet: {self.current_session_id}")
     
-    async def process_query(self, query: str) -> str:
+    def _save_turn(self, session_id: str, messages: List[Dict[str, Any]]):
         """
-        Prosesser brukerforespørsel med AI og MCP verktøy.
+        Lagre en samtaletur i bakgrunnen.
+        
+        Turen legges i kø, og én skriveoppgave tømmer køen. Turer som kommer
+        mens en skriving pågår, lagres samlet i neste transaksjon.
         """
-        if not self.current_session_id:
-            self.start_new_session()
+        self._pending_turns.append((session_id, messages))
+        if self._memory_write is None or self._memory_write.done():
+            self._memory_write = asyncio.create_task(self._flush_turns())
+    
+    async def _flush_turns(self):
+        """Skriv ventende turer i rekkefølge, inntil MEMORY_WRITE_BATCH per transaksjon."""
+        while self._pending_turns:
+            batch = self._pending_turns[:MEMORY_WRITE_BATCH]
+            del self._pending_turns[:MEMORY_WRITE_BATCH]
+            try:
+                await asyncio.to_thread(self.memory.add_turns, batch)
+            except Exception as e:
+                # Feil logges i stedet for å forsvinne i en oppgave ingen venter på
+                logger.error(f"Kunne ikke lagre samtale: {e}")
+    
+    async def _answer_weather_directly(self, query: str, city: str,
+                                       on_token: Optional[Callable[[str], None]] = None) -> Optional[str]:
+        """
+        Besvar et enkelt værspørsmål uten at modellen velger verktøy.
         
-        try:
-            # Hent samtalehistorikk
-            history = self.memory.get_conversation_history(self.current_session_id)
+        Verktøyet kalles direkte og modellen får resultatet som om den hadde
+        bedt om det selv, slik at det bare trengs ett kort AI-kall. Returnerer
+        None hvis verktøyet feiler, så spørsmålet kan gå via full agentløype.
+        """
+        arguments = {"location": city}
+        tool_result = await self.call_mcp_tool(PREFETCH_TOOL, arguments)
+        data = orjson.loads(tool_result)
+        if isinstance(data, dict) and "error" in data:
+            return None
+        
+        logger.debug("Direkte værsvar for %s", city)
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": query},
+            {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": "direct_weather",
+                    "type": "function",
+                    "function": {"name": PREFETCH_TOOL, "arguments": orjson.dumps(arguments).decode()}
+                }]
+            },
+            {"role": "tool", "content": tool_result, "tool_call_id": "direct_weather"}
+        ]
+        content, _ = await self._stream_completion(
+            messages, on_token=on_token, max_tokens=DIRECT_ANSWER_MAX_TOKENS
+        )
+        return content
+    
+    async def _answer_with_tools(self, query: str,
+                                 on_token: Optional[Callable[[str], None]] = None) -> str:
+        """Besvar spørsmålet med samtalehistorikk og verktøykall i runder."""
+        # Hent samtalehistorikk - SQLite kjøres i egen tråd for ikke å blokkere event loop
+        history = []
+        if self.memory:
+            # Forrige tur må være lagret før historikken leses
+            if self._memory_write:
+                await asyncio.shield(self._memory_write)
+            # Sammendraget leses fra databasen første gang sesjonen brukes i prosessen
+            if self.current_session_id not in self._summaries:
+                summary, summary_until = await asyncio.to_thread(
+                    self.memory.get_session_summary, self.current_session_id
+                )
+                self._summaries[self.current_session_id] = summary or ""
+                self._summary_markers[self.current_session_id] = summary_until
             
-            # Bygg meldinger for OpenAI
-            messages = [
-                {
-                    "role": "system",
-                    "content": """Du er Ingrid, en vennlig og kompetent agent fra Ingrids Reisetjenester. 
-
-Du har kun lov å bruke ett verktøy, og det er det for å hente værinformasjon i hele verden. Hvis brukeren spør om noe annet enn vær, skal forespørselen avvises på en hyggelig måte.
-
-Utover det, vær vennlig, personlig og hjelpsom - du representerer Ingrids Reisetjenester.
-Svar på norsk med mindre brukeren spør på et annet språk.
-
-MERK: Dette er LAB02 versjon med dynamisk tools discovery."""
-                }
-            ]
+            # Alt etter siste oppsummerte melding hentes; token-budsjettet avgjør
+            # hva som sendes, og resten oppsummeres
+            history = await asyncio.to_thread(
+                self.memory.get_context_since, self.current_session_id,
+                after_id=self._summary_markers[self.current_session_id]
+            )
+        
+        history = [msg for msg in history if msg["role"] in ("user", "assistant")]
+        history, to_summarize = self._trim_history(history)
+        if to_summarize:
+            self._schedule_summary(self.current_session_id, to_summarize)
+        
+        # Bygg meldinger for OpenAI
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT}
+        ]
+        
+        # Sammendraget endres sjelden og ligger rett etter systemprompten,
+        # slik at det blir en del av det cachede prefikset
+        summary = self._summaries.get(self.current_session_id)
+        if summary:
+            messages.append({"role": "system", "content": f"Sammendrag av tidligere samtale:\n{summary}"})
+        
+        # Legg til samtalehistorikk. Bare rolle og tekst sendes: verktøyresultater
+        # lagres ikke, så kallene kan ikke sendes alene, og id-en brukes bare til
+        # oppsummering (de samme meldingene kan ligge i oppsummeringskøen).
+        messages.extend({"role": msg["role"], "content": msg["content"]} for msg in history)
+        
+        # Legg til ny brukermelding
+        messages.append({"role": "user", "content": query})
+        
+        # AI-kall i runder: så lenge modellen ber om verktøy kjøres alle kallene
+        # parallelt og resultatene sendes tilbake. Verktøykall startes mens
+        # svaret strømmes.
+        tool_tasks = []
+        tasks_by_call = {}
+        
+        def start_tool_call(tool_call: Dict[str, Any]):
+            # Identiske kall i samme svar deler ett MCP-kall
+            key = (tool_call["function"]["name"], tool_call["function"]["arguments"])
+            task = tasks_by_call.get(key)
+            if task is None:
+                task = tasks_by_call[key] = asyncio.create_task(self._execute_tool_call(tool_call))
+            tool_tasks.append(task)
+        
+        for round_number in range(MAX_TOOL_ROUNDS + 1):
+            # Siste runde sendes uten tools slik at modellen må gi et svar
+            tools = self.tools if round_number < MAX_TOOL_ROUNDS else None
+            tool_tasks.clear()
+            tasks_by_call.clear()
             
-            # Legg til samtalehistorikk
-            for msg in history:
-                if msg["role"] == "user":
-                    messages.append({"role": "user", "content": msg["content"]})
-                elif msg["role"] == "assistant":
-                    messages.append({"role": "assistant", "content": msg["content"]})
+            try:
+                content, tool_calls = await self._stream_completion(
+                    messages,
+                    tools=tools,
+                    on_token=on_token,
+                    on_tool_call=start_tool_call
+                )
+            except BaseException:
+                for task in tool_tasks:
+                    task.cancel()
+                raise
             
-            # Legg til ny brukermelding
-            messages.append({"role": "user", "content": query})
+            if not tool_calls:
+                final_answer = content
+                break
             
-            # Første AI-kall med OpenAI
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
-                tools=self.tools,
-                tool_choice="auto"
-            )
+            # Legg til assistant melding med tool calls
+            messages.append({
+                "role": "assistant", 
+                "content": content or None,
+                "tool_calls": tool_calls
+            })
             
-            response_message = response.choices[0].message
+            # Vent på MCP-kallene som allerede kjører
+            tool_results = await asyncio.gather(*tool_tasks)
             
-            # Håndter verktøykall
-            if response_message.tool_calls:
-                # Legg til assistant melding med tool calls
+            for tool_call, tool_result in zip(tool_calls, tool_results):
                 messages.append({
-                    "role": "assistant", 
-                    "content": response_message.content,
-                    "tool_calls": [{"id": tc.id, "type": tc.type, "function": {"name": tc.function.name, "arguments": tc.function.arguments}} for tc in response_message.tool_calls]
+                    "role": "tool",
+                    "content": tool_result,
+                    "tool_call_id": tool_call["id"]
                 })
-                
-                for tool_call in response_message.tool_calls:
-                    function_name = tool_call.function.name
-                    arguments = json.loads(tool_call.function.arguments)
-                    
-                    # Kall MCP server
-                    tool_result = await self.call_mcp_tool(function_name, arguments)
-                    
-                    messages.append({
-                        "role": "tool",
-                        "content": tool_result,
-                        "tool_call_id": tool_call.id
-                    })
-                
-                logger.info("Verktøykall fullført, henter endelig svar...")
-                
-                # Få endelig svar med OpenAI
-                final_response = self.client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=messages
-                )
-                
-                final_answer = final_response.choices[0].message.content
-            else:
-                final_answer = response_message.content
             
-            # Lagre samtale
-            self.memory.add_message(self.current_session_id, "user", query)
-            self.memory.add_message(self.current_session_id, "assistant", final_answer)
+            logger.debug("Verktøykall fullført (runde %d), henter neste svar...", round_number + 1)
+        
+        return final_answer
+    
+    async def process_query(self, query: str,
+                            on_token: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Prosesser brukerforespørsel med AI og MCP verktøy.
+        
+        Args:
+            query: Brukerens spørsmål
+            on_token: Valgfri callback som mottar svaret bit for bit mens det genereres
+        """
+        if not self.current_session_id:
+            self.start_new_session()
+        
+        # Prøv å hente tools på nytt hvis MCP server var nede ved oppstart
+        if not self.tools and time.monotonic() - self._last_connect_attempt >= TOOLS_RETRY_INTERVAL:
+            await self.connect()
+        
+        try:
+            # Enkle værspørsmål går rett til verktøyet; ellers full agentløype
+            final_answer = None
+            direct = _DIRECT_WEATHER_RE.match(query)
+            if direct and PREFETCH_TOOL in self._tool_names:
+                city = _CITY_NAMES[direct.group("city").lower()]
+                final_answer = await self._answer_weather_directly(query, city, on_token)
+            
+            if final_answer is None:
+                final_answer = await self._answer_with_tools(query, on_token)
+            
+            # Lagre samtale i bakgrunnen - svaret returneres uten å vente på disk
+            if self.memory:
+                self._save_turn(self.current_session_id, [
+                    {"role": "user", "content": query},
+                    {"role": "assistant", "content": final_answer}
+                ])
+            
+            # Bruk tiden til neste spørsmål på å hente vær for byer som ble nevnt
+            self._prefetch_mentioned_cities(f"{query}\n{final_answer}")
             
             return final_answer
             
@@ -270,68 +826,110 @@ MERK: Dette er LAB02 versjon med dynamisk tools discovery."""
             logger.error(f"Query processing error: {e}")
             return f"Beklager, jeg fikk en feil: {str(e)}"
     
+    async def connect(self) -> bool:
+        """
+        Gjør agenten klar til bruk: last inn tools fra MCP server.
+        
+        Idempotent - returnerer med en gang hvis tools allerede er lastet.
+        HTTP-klientene er langlivede og gjenbrukes for alle forespørsler frem
+        til close() kalles.
+        """
+        async with self._connect_lock:
+            if self.tools:
+                return True
+            
+            self._last_connect_attempt = time.monotonic()
+            tools_loaded = await self.load_tools_from_mcp_server()
+            if not tools_loaded:
+                logger.warning("Kunne ikke laste tools fra MCP server, fortsetter uten tools")
+            return tools_loaded
+    
     async def close(self):
         """Clean up ressurser."""
-        await self.http_client.aclose()
+        # Delte verktøykall er skjermet mot at kallerne avbrytes, så de avbrytes
+        # eksplisitt. Alle oppgavene må være ferdige før klientene lukkes.
+        tasks = [*self._summary_tasks.values(), *self._prefetch_tasks,
+                 *self._inflight_tool_calls.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for close_client in self._owned_client_closers:
+            await close_client()
+        if self.memory:
+            # Ventende skrivinger fullføres før databasen lukkes
+            if self._memory_write:
+                await self._memory_write
+            self.memory.close()
+    
+    async def __aenter__(self):
+        await self.connect()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
 # Test funksjon
 async def main():
     """CLI interface for testing."""
-    agent = MicroserviceAgent()
+    # Skriv ut svaret etter hvert som det genereres
+    printed = []
+    def print_token(token: str):
+        printed.append(token)
+        print(token, end="", flush=True)
     
-    # Last inn tools fra MCP server
-    tools_loaded = await agent.load_tools_from_mcp_server()
-    if not tools_loaded:
-        logger.warning("Kunne ikke laste tools fra MCP server, fortsetter uten tools")
-    
-    agent.start_new_session("Test Session")
-    
-    while True:
-        query = input("Du: ").strip()
-        if query.lower() in ['quit', 'exit', 'q']:
-            break
+    async with MicroserviceAgent() as agent:
+        agent.start_new_session("Test Session")
         
-        response = await agent.process_query(query)
-        print(f"Ingrid: {response}\n")
-    
-    await agent.close()
+        while True:
+            # Les input i egen tråd slik at bakgrunnsoppgaver kjører mens brukeren skriver
+            query = (await asyncio.to_thread(input, "Du: ")).strip()
+            if query.lower() in ['quit', 'exit', 'q']:
+                break
+            
+            printed.clear()
+            print("Ingrid: ", end="", flush=True)
+            response = await agent.process_query(query, on_token=print_token)
+            if not printed:
+                # Feilmeldinger og lignende strømmes ikke
+                print(response, end="")
+            print("\n")
 
 def start_agent_api():
     """Start agent som HTTP API service."""
     from fastapi import FastAPI, HTTPException
+    from fastapi.responses import StreamingResponse
     from pydantic import BaseModel
-    from contextlib import asynccontextmanager
+    from contextlib import AsyncExitStack, asynccontextmanager
     import uvicorn
     
-    # Global agent instance - definert på modul nivå
-    global agent_instance
-    agent_instance = None
-    
     @asynccontextmanager
     async def lifespan(app: FastAPI):
         # Startup
         global agent_instance
         logger.info("Starter Ingrid Agent Service...")
-        try:
-            agent_instance = MicroserviceAgent()
+        async with AsyncExitStack() as stack:
+            try:
+                # Klientene deles av alle forespørsler og lukkes etter agenten
+                openai_client = create_openai_client()
+                stack.push_async_callback(openai_client.close)
+                mcp_http_client = create_mcp_http_client()
+                stack.push_async_callback(mcp_http_client.aclose)
+                
+                # Agenten lever så lenge tjenesten kjører
+                agent_instance = await stack.enter_async_context(
+                    MicroserviceAgent(openai_client=openai_client, http_client=mcp_http_client)
+                )
+                agent_instance.start_new_session("HTTP API Session")
+                logger.info("Ingrid Agent Service startet")
+                logger.info(f"Agent instance created: {agent_instance is not None}")
+            except Exception as e:
+                logger.error(f"Failed to start agent: {e}")
+                agent_instance = None
             
-            # Last inn tools fra MCP server
-            tools_loaded = await agent_instance.load_tools_from_mcp_server()
-            if not tools_loaded:
-                logger.warning("Kunne ikke laste tools fra MCP server, fortsetter uten tools")
+            yield
             
-            agent_instance.start_new_session("HTTP API Session")
-            logger.info("Ingrid Agent Service startet")
-            logger.info(f"Agent instance created: {agent_instance is not None}")
-        except Exception as e:
-            logger.error(f"Failed to start agent: {e}")
+            # Shutdown - stack lukker agenten
             agent_instance = None
-        
-        yield
-        
-        # Shutdown
-        if agent_instance:
-            await agent_instance.close()
         logger.info("Ingrid Agent Service avsluttet")
     
     # FastAPI app for agent
@@ -362,17 +960,16 @@ def start_agent_api():
     @agent_app.post("/query", response_model=QueryResponse)
     async def process_query_api(request: QueryRequest):
         global agent_instance
-        logger.info(f"Query request received: {request.query}")
-        logger.info(f"Agent instance status: {agent_instance is not None}")
+        logger.debug("Query request received: %s", request.query)
         
         if not agent_instance:
             logger.error("Agent instance is None!")
             raise HTTPException(status_code=503, detail="Agent ikke tilgjengelig")
         
         try:
-            logger.info("Processing query with agent...")
+            logger.debug("Processing query with agent...")
             response = await agent_instance.process_query(request.query)
-            logger.info("Query processed successfully")
+            logger.debug("Query processed successfully")
             return QueryResponse(
                 success=True,
                 response=response,
@@ -382,9 +979,40 @@ def start_agent_api():
             logger.error(f"Query processing error: {e}")
             raise HTTPException(status_code=500, detail=str(e))
     
+    @agent_app.post("/query/stream")
+    async def process_query_stream_api(request: QueryRequest):
+        """
+        Som /query, men svaret strømmes som Server-Sent Events mens det genereres.
+        
+        Hver tekstbit sendes som `data: {"token": ...}`. Til slutt kommer
+        `event: done` med hele svaret, som også dekker svar som ikke ble
+        strømmet (f.eks. feilmeldinger).
+        """
+        if not agent_instance:
+            logger.error("Agent instance is None!")
+            raise HTTPException(status_code=503, detail="Agent ikke tilgjengelig")
+        
+        tokens: asyncio.Queue = asyncio.Queue()
+        
+        async def events():
+            task = asyncio.create_task(agent_instance.process_query(request.query, on_token=tokens.put_nowait))
+            # Vekk ventingen på neste tekstbit når svaret er ferdig
+            task.add_done_callback(lambda _: tokens.put_nowait(None))
+            try:
+                while (token := await tokens.get()) is not None:
+                    yield b"data: " + orjson.dumps({"token": token}) + b"\n\n"
+                yield b"event: done\ndata: " + orjson.dumps({"response": task.result()}) + b"\n\n"
+            finally:
+                # Klienten koblet fra før svaret var ferdig
+                task.cancel()
+        
+        return StreamingResponse(events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
+    
     # Start HTTP server
     logger.info("Starting Agent API on port 8001...")
-    uvicorn.run(agent_app, host="0.0.0.0", port=8001)
+    # uvloop/httptools når de er installert, ellers asyncio/h11 (se mcp-server)
+    uvicorn.run(agent_app, host="0.0.0.0", port=8001, loop="auto", http="auto")
 
 if __name__ == "__main__":
     logger.info("Starting Agent Service on port 8001...")
@@ -7,12 +7,48 @@ Håndterer lagring og henting av samtalehistorikk med SQLite database.
 import sqlite3
 import json
 import logging
-from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+import secrets
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+# tool_calls og metadata lagres som JSON i BLOB-kolonner. _loads godtar også
+# TEXT-verdier fra databaser opprettet før kolonnene ble BLOB.
+try:
+    import orjson
+    
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:  # orjson mangler - bruk standardbiblioteket
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+    
+    _loads = json.loads
+
+def _pack_message(tool_calls: Optional[List[Dict]],
+                  metadata: Optional[Dict]) -> Tuple[Optional[bytes], Optional[bytes]]:
+    """Serialiser tool_calls og metadata til BLOB-verdier for én rad."""
+    return (_dumps(tool_calls) if tool_calls else None,
+            _dumps(metadata) if metadata else None)
+
+def _unpack_row(row: Tuple) -> Dict[str, Any]:
+    """Bygg en melding fra (role, content, tool_calls, metadata, timestamp)."""
+    role, content, tool_calls_json, metadata_json, timestamp = row
+    message = {"role": role, "content": content, "timestamp": timestamp}
+    if tool_calls_json:
+        message["tool_calls"] = _loads(tool_calls_json)
+    if metadata_json:
+        message["metadata"] = _loads(metadata_json)
+    return message
+
+# Antall nylige meldinger per sesjon som holdes i minnet, som (id, melding)
+RECENT_BUFFER_SIZE = 50
+
 class ConversationMemory:
     """Persistent hukommelse for samtaler med SQLite database."""
     
@@ -24,18 +60,57 @@ class ConversationMemory:
             db_path: Sti til SQLite database fil
         """
         self.db_path = db_path
+        # ":memory:" gir en database uten fil (f.eks. i tester); da finnes verken
+        # katalog, WAL-logg eller fil å minnemappe
+        self._in_memory = db_path == ":memory:"
+        
+        # Nylige meldinger i OpenAI format per (user_id, session_id), kun for
+        # sesjoner opprettet av denne prosessen der bufferen er komplett
+        self._recent: Dict[Tuple[str, str], deque] = {}
+        self._new_sessions = set()
         
         # Opprett data katalog hvis den ikke eksisterer
-        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        if not self._in_memory:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        
+        # Én langlivet tilkobling for hele instansen. Metodene kalles fra
+        # arbeidstråder (asyncio.to_thread), så tilgang serialiseres med en lås.
+        self._lock = threading.Lock()
+        self._conn = self._connect()
         
         # Initialiser database
         self._init_database()
         
+    def _connect(self) -> sqlite3.Connection:
+        """Åpne databasetilkobling innstilt for hyppige, små skriv."""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        # WAL gjør at en commit ikke trenger full fsync av databasefilen
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        # 64 MB sidecache og 256 MB minnemappet lesing
+        conn.execute("PRAGMA cache_size=-65536")
+        if not self._in_memory:
+            conn.execute("PRAGMA mmap_size=268435456")
+        return conn
+    
+    def _recent_buffer(self, session_id: str, user_id: str) -> Optional[deque]:
+        """Hent minnebuffer for en sesjon, eller None hvis databasen må brukes."""
+        key = (user_id, session_id)
+        buffer = self._recent.get(key)
+        if buffer is None and session_id in self._new_sessions:
+            buffer = self._recent[key] = deque(maxlen=RECENT_BUFFER_SIZE)
+        return buffer
+    
     def _init_database(self):
         """Opprett database tabeller hvis de ikke eksisterer."""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock, self._conn as conn:
             cursor = conn.cursor()
             
+            # Write-ahead logging lagres i databasefilen og gjelder alle tilkoblinger.
+            # SQLite legger da -wal og -shm filer ved siden av databasen i data/.
+            if not self._in_memory:
+                cursor.execute("PRAGMA journal_mode=WAL")
+            
             # Hovedtabell for samtaler
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS conversations (
@@ -44,8 +119,8 @@ class ConversationMemory:
                     session_id TEXT NOT NULL,
                     role TEXT NOT NULL,
                     content TEXT NOT NULL,
-                    tool_calls TEXT,
-                    metadata TEXT,
+                    tool_calls BLOB,
+                    metadata BLOB,
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
@@ -59,14 +134,25 @@ class ConversationMemory:
                     title TEXT,
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                     last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    message_count INTEGER DEFAULT 0
+                    message_count INTEGER DEFAULT 0,
+                    summary TEXT,
+                    summary_until INTEGER NOT NULL DEFAULT 0
                 )
             """)
             
-            # Indekser for bedre ytelse
+            # Databaser opprettet før sammendrag ble lagret mangler kolonnen
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(sessions)")}
+            if "summary" not in columns:
+                cursor.execute("ALTER TABLE sessions ADD COLUMN summary TEXT")
+            if "summary_until" not in columns:
+                cursor.execute("ALTER TABLE sessions ADD COLUMN summary_until INTEGER NOT NULL DEFAULT 0")
+            
+            # Indekser for bedre ytelse. Meldinger sorteres på id, som følger
+            # innsettingsrekkefølgen, slik at indeksen gir ferdig sortert historikk.
+            cursor.execute("DROP INDEX IF EXISTS idx_conversations_user_session")
             cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_conversations_user_session 
-                ON conversations(user_id, session_id, timestamp)
+                CREATE INDEX IF NOT EXISTS idx_conversations_user_session_id 
+                ON conversations(user_id, session_id, id)
             """)
             
             cursor.execute("""
@@ -74,6 +160,23 @@ class ConversationMemory:
                 ON conversations(timestamp)
             """)
             
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_sessions_activity 
+                ON sessions(last_activity)
+            """)
+            
+            # Sesjonsstatistikk oppdateres av databasen for hver ny melding
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS trg_sessions_activity
+                AFTER INSERT ON conversations
+                BEGIN
+                    UPDATE sessions
+                    SET last_activity = CURRENT_TIMESTAMP,
+                        message_count = message_count + 1
+                    WHERE session_id = NEW.session_id;
+                END
+            """)
+            
             conn.commit()
             logger.info(f"Database initialisert: {self.db_path}")
     
@@ -88,16 +191,19 @@ class ConversationMemory:
         Returns:
             Session ID
         """
-        session_id = f"{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        # Millisekund-tidsstempel + tilfeldig suffiks: unik også for sesjoner
+        # opprettet samtidig, og sorterer etter opprettelsestid
+        session_id = f"{user_id}_{time.time_ns() // 1_000_000:012x}{secrets.token_hex(5)}"
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock, self._conn as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 INSERT INTO sessions (session_id, user_id, title)
                 VALUES (?, ?, ?)
             """, (session_id, user_id, title))
             conn.commit()
-            
+        
+        self._new_sessions.add(session_id)
         logger.info(f"Ny sesjon opprettet: {session_id}")
         return session_id
     
@@ -116,31 +222,93 @@ class ConversationMemory:
             metadata: Ekstra metadata
             user_id: Bruker ID
         """
-        tool_calls_json = json.dumps(tool_calls) if tool_calls else None
-        metadata_json = json.dumps(metadata) if metadata else None
+        tool_calls_json, metadata_json = _pack_message(tool_calls, metadata)
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock, self._conn as conn:
             cursor = conn.cursor()
             
-            # Legg til melding
+            # Legg til melding (sesjon statistikk oppdateres av trg_sessions_activity)
             cursor.execute("""
                 INSERT INTO conversations (user_id, session_id, role, content, tool_calls, metadata)
                 VALUES (?, ?, ?, ?, ?, ?)
             """, (user_id, session_id, role, content, tool_calls_json, metadata_json))
+            message_id = cursor.lastrowid
             
-            # Oppdater sesjon statistikk
-            cursor.execute("""
-                UPDATE sessions 
-                SET last_activity = CURRENT_TIMESTAMP,
-                    message_count = message_count + 1
-                WHERE session_id = ?
-            """, (session_id,))
+            conn.commit()
+        
+        buffer = self._recent_buffer(session_id, user_id)
+        if buffer is not None:
+            buffer.append((message_id, self._to_openai_message(role, content, tool_calls)))
+    
+    def add_messages(self, session_id: str, messages: List[Dict[str, Any]],
+                     user_id: str = "default"):
+        """
+        Legg til flere meldinger i samtalehistorikk i én transaksjon.
+        
+        Args:
+            session_id: Sesjon ID
+            messages: Meldinger med role, content og valgfritt tool_calls/metadata
+            user_id: Bruker ID
+        """
+        self.add_turns([(session_id, messages)], user_id=user_id)
+    
+    def add_turns(self, turns: List[Tuple[str, List[Dict[str, Any]]]],
+                  user_id: str = "default"):
+        """
+        Legg til meldinger for flere samtaleturer i én transaksjon.
+        
+        Args:
+            turns: Liste av (session_id, meldinger) i rekkefølgen de skal lagres
+            user_id: Bruker ID
+        """
+        rows = [
+            (user_id, session_id, message["role"], message["content"],
+             *_pack_message(message.get("tool_calls"), message.get("metadata")))
+            for session_id, messages in turns
+            for message in messages
+        ]
+        if not rows:
+            return
+        
+        with self._lock, self._conn as conn:
+            cursor = conn.cursor()
+            
+            # Legg til meldinger (triggeren kjører per rad). Radene settes inn én
+            # og én i samme transaksjon, så hver melding får sin id til bufferen.
+            message_ids = []
+            for row in rows:
+                cursor.execute("""
+                    INSERT INTO conversations (user_id, session_id, role, content, tool_calls, metadata)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, row)
+                message_ids.append(cursor.lastrowid)
             
             conn.commit()
+        
+        position = 0
+        for session_id, messages in turns:
+            turn_ids = message_ids[position:position + len(messages)]
+            position += len(messages)
+            buffer = self._recent_buffer(session_id, user_id)
+            if buffer is not None:
+                buffer.extend(zip(turn_ids, (
+                    self._to_openai_message(message["role"], message["content"], message.get("tool_calls"))
+                    for message in messages
+                )))
+    
+    @staticmethod
+    def _to_openai_message(role: str, content: str,
+                           tool_calls: Optional[List[Dict]] = None) -> Dict[str, Any]:
+        """Konverter en melding til OpenAI format."""
+        message = {"role": role, "content": content}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        return message
     
     def get_conversation_history(self, session_id: str, 
                                limit: int = 50,
-                               user_id: str = "default") -> List[Dict[str, Any]]:
+                               user_id: str = "default",
+                               include_metadata: bool = True) -> List[Dict[str, Any]]:
         """
         Hent samtalehistorikk for en sesjon.
         
@@ -148,39 +316,26 @@ class ConversationMemory:
             session_id: Sesjon ID
             limit: Maksimalt antall meldinger
             user_id: Bruker ID
+            include_metadata: Hent og dekod metadata-kolonnen
             
         Returns:
             Liste med meldinger
         """
-        with sqlite3.connect(self.db_path) as conn:
+        # Metadata hentes bare når den trengs, så den ikke må leses og dekodes
+        metadata_column = "metadata" if include_metadata else "NULL"
+        
+        with self._lock, self._conn as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT role, content, tool_calls, metadata, timestamp
+            cursor.execute(f"""
+                SELECT role, content, tool_calls, {metadata_column}, timestamp
                 FROM conversations
                 WHERE user_id = ? AND session_id = ?
-                ORDER BY timestamp ASC
+                ORDER BY id ASC
                 LIMIT ?
             """, (user_id, session_id, limit))
-            
-            messages = []
-            for row in cursor.fetchall():
-                role, content, tool_calls_json, metadata_json, timestamp = row
-                
-                message = {
-                    "role": role,
-                    "content": content,
-                    "timestamp": timestamp
-                }
-                
-                if tool_calls_json:
-                    message["tool_calls"] = json.loads(tool_calls_json)
-                
-                if metadata_json:
-                    message["metadata"] = json.loads(metadata_json)
-                
-                messages.append(message)
-            
-            return messages
+            rows = cursor.fetchall()
+        
+        return [_unpack_row(row) for row in rows]
     
     def get_recent_context(self, session_id: str, 
                           context_window: int = 10,
@@ -196,23 +351,101 @@ class ConversationMemory:
         Returns:
             Liste med nylige meldinger formatert for OpenAI
         """
-        messages = self.get_conversation_history(session_id, context_window, user_id)
+        # Sesjoner opprettet av denne prosessen hentes fra minnet
+        buffer = self._recent_buffer(session_id, user_id)
+        if buffer is not None and context_window <= RECENT_BUFFER_SIZE:
+            start = max(len(buffer) - context_window, 0)
+            return [dict(buffer[i][1]) for i in range(start, len(buffer))]
+        
+        # Nyeste meldinger først via indeksen, så snus den lille listen
+        with self._lock, self._conn as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT role, content, tool_calls
+                FROM conversations
+                WHERE user_id = ? AND session_id = ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (user_id, session_id, context_window))
+            rows = cursor.fetchall()
+        
+        rows.reverse()
         
         # Konverter til OpenAI format
-        openai_messages = []
-        for msg in messages:
-            openai_msg = {
-                "role": msg["role"],
-                "content": msg["content"]
-            }
+        return [
+            self._to_openai_message(role, content, _loads(tool_calls_json) if tool_calls_json else None)
+            for role, content, tool_calls_json in rows
+        ]
+    
+    def get_context_since(self, session_id: str, after_id: int = 0,
+                          user_id: str = "default") -> List[Dict[str, Any]]:
+        """
+        Hent alle meldinger i en sesjon etter en gitt melding.
+        
+        Brukes med id-en til siste oppsummerte melding, slik at resten av
+        historikken hentes uten et fast tak på antall meldinger.
+        
+        Args:
+            session_id: Sesjon ID
+            after_id: Meldinger med id større enn denne hentes
+            user_id: Bruker ID
             
-            # Legg til tool_calls hvis de finnes
-            if "tool_calls" in msg and msg["tool_calls"]:
-                openai_msg["tool_calls"] = msg["tool_calls"]
+        Returns:
+            Meldinger i OpenAI format, med meldingens id under "id"
+        """
+        # Bufferen kan brukes hvis den har hele sesjonen eller når forbi after_id
+        buffer = self._recent_buffer(session_id, user_id)
+        if buffer is not None and (len(buffer) < RECENT_BUFFER_SIZE or buffer[0][0] <= after_id):
+            return [{**message, "id": message_id} for message_id, message in buffer if message_id > after_id]
+        
+        with self._lock, self._conn as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, role, content, tool_calls
+                FROM conversations
+                WHERE user_id = ? AND session_id = ? AND id > ?
+                ORDER BY id ASC
+            """, (user_id, session_id, after_id))
+            rows = cursor.fetchall()
+        
+        return [
+            {**self._to_openai_message(role, content, _loads(tool_calls_json) if tool_calls_json else None),
+             "id": message_id}
+            for message_id, role, content, tool_calls_json in rows
+        ]
+    
+    def get_session_summary(self, session_id: str) -> Tuple[Optional[str], int]:
+        """
+        Hent lagret sammendrag av eldre meldinger i en sesjon.
+        
+        Args:
+            session_id: Sesjon ID
             
-            openai_messages.append(openai_msg)
+        Returns:
+            (sammendrag, id til siste oppsummerte melding), eller (None, 0)
+            hvis sesjonen ikke har noe sammendrag
+        """
+        with self._lock, self._conn as conn:
+            row = conn.execute(
+                "SELECT summary, summary_until FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+    
+    def set_session_summary(self, session_id: str, summary: str, summary_until: int):
+        """
+        Lagre sammendrag av eldre meldinger i en sesjon.
         
-        return openai_messages
+        Args:
+            session_id: Sesjon ID
+            summary: Sammendrag som erstatter et eventuelt tidligere
+            summary_until: Id til siste melding sammendraget dekker
+        """
+        with self._lock, self._conn as conn:
+            conn.execute(
+                "UPDATE sessions SET summary = ?, summary_until = ? WHERE session_id = ?",
+                (summary, summary_until, session_id)
+            )
+            conn.commit()
     
     def get_sessions(self, user_id: str = "default", 
                     limit: int = 20) -> List[Dict[str, Any]]:
@@ -226,7 +459,7 @@ class ConversationMemory:
         Returns:
             Liste med sesjon informasjon
         """
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock, self._conn as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT session_id, title, created_at, last_activity, message_count
@@ -258,9 +491,12 @@ class ConversationMemory:
             days_old: Antall dager gamle samtaler som skal slettes
             user_id: Spesifikk bruker ID, eller None for alle brukere
         """
-        cutoff_date = datetime.now() - timedelta(days=days_old)
+        # Samme format og tidssone (UTC) som CURRENT_TIMESTAMP, så sammenligningen
+        # skjer som ren tekst mot indeksene
+        cutoff_date = (datetime.now(timezone.utc) - timedelta(days=days_old)).strftime("%Y-%m-%d %H:%M:%S")
         
-        with sqlite3.connect(self.db_path) as conn:
+        # Begge slettingene kjøres i samme transaksjon
+        with self._lock, self._conn as conn:
             cursor = conn.cursor()
             
             if user_id:
@@ -268,6 +504,7 @@ class ConversationMemory:
                     DELETE FROM conversations 
                     WHERE user_id = ? AND timestamp < ?
                 """, (user_id, cutoff_date))
+                deleted_conversations = cursor.rowcount
                 
                 cursor.execute("""
                     DELETE FROM sessions 
@@ -278,15 +515,22 @@ class ConversationMemory:
                     DELETE FROM conversations 
                     WHERE timestamp < ?
                 """, (cutoff_date,))
+                deleted_conversations = cursor.rowcount
                 
                 cursor.execute("""
                     DELETE FROM sessions 
                     WHERE last_activity < ?
                 """, (cutoff_date,))
             
-            deleted_conversations = cursor.rowcount
             conn.commit()
             
+            # Minnebuffere kan inneholde slettede meldinger. Bufferen har ingen
+            # tidsstempler, så berørte sesjoner leses fra databasen fra nå av.
+            if deleted_conversations:
+                for key in [key for key in self._recent if user_id is None or key[0] == user_id]:
+                    del self._recent[key]
+                    self._new_sessions.discard(key[1])
+            
             logger.info(f"Slettet {deleted_conversations} gamle samtaler eldre enn {days_old} dager")
     
     def get_database_stats(self) -> Dict[str, Any]:
@@ -296,23 +540,21 @@ class ConversationMemory:
         Returns:
             Dictionary med database statistikk
         """
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock, self._conn as conn:
             cursor = conn.cursor()
             
-            # Antall samtaler
-            cursor.execute("SELECT COUNT(*) FROM conversations")
-            total_messages = cursor.fetchone()[0]
-            
-            # Antall sesjoner
-            cursor.execute("SELECT COUNT(*) FROM sessions")
-            total_sessions = cursor.fetchone()[0]
-            
-            # Antall unike brukere
-            cursor.execute("SELECT COUNT(DISTINCT user_id) FROM sessions")
-            unique_users = cursor.fetchone()[0]
+            # Antall samtaler, sesjoner og unike brukere i ett kall
+            cursor.execute("""
+                SELECT (SELECT COUNT(*) FROM conversations),
+                       (SELECT COUNT(*) FROM sessions),
+                       (SELECT COUNT(DISTINCT user_id) FROM sessions)
+            """)
+            total_messages, total_sessions, unique_users = cursor.fetchone()
             
-            # Database størrelse
-            db_size = Path(self.db_path).stat().st_size / (1024 * 1024)  # MB
+            # Database størrelse fra SQLite selv, uten å lese filsystemet
+            page_count = cursor.execute("PRAGMA page_count").fetchone()[0]
+            page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+            db_size = page_count * page_size / (1024 * 1024)  # MB
             
             return {
                 "total_messages": total_messages,
@@ -321,3 +563,8 @@ class ConversationMemory:
                 "database_size_mb": round(db_size, 2),
                 "database_path": self.db_path
             }
+    
+    def close(self):
+        """Lukk databasetilkoblingen."""
+        with self._lock:
+            self._conn.close()
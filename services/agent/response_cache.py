@@ -0,0 +1,70 @@
+"""
+Response Cache for Travel Weather Agent
+
+Enkel in-memory cache med TTL og LRU-utkastelse for svar som er dyre å hente.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+class TTLCache:
+    """In-memory cache der hver verdi utløper etter en gitt tid."""
+
+    def __init__(self, default_ttl: float = 3600, max_entries: int = 256):
+        """
+        Initialiser cache.
+
+        Args:
+            default_ttl: Standard levetid i sekunder
+            max_entries: Maksimalt antall verdier før eldste brukte kastes ut
+        """
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0}
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Hent verdi fra cache.
+
+        Args:
+            key: Cache-nøkkel
+
+        Returns:
+            Verdien, eller None hvis den mangler eller er utløpt
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.stats["misses"] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """
+        Lagre verdi i cache.
+
+        Args:
+            key: Cache-nøkkel
+            value: Verdien som skal lagres
+            ttl: Levetid i sekunder, eller None for standard levetid
+        """
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Tøm cache."""
+        self._entries.clear()
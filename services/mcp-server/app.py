@@ -10,25 +10,26 @@ import asyncio
 import json
 import logging
 import os
-from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
 
 import httpx
+import orjson
 import uvicorn
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
 # Konfigurer logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# FastAPI app
-app = FastAPI(
-    title="MCP API Server - Lab02",
-    description="Forenklet HTTP API for workshop med kun værfunksjonalitet",
-    version="1.0.0"
-)
-
 # API konstanter
 WEATHER_API_BASE = "https://api.openweathermap.org/data/2.5"
 NOMINATIM_API_BASE = "https://nominatim.openstreetmap.org"
@@ -39,95 +40,389 @@ OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY")
 if not OPENWEATHER_API_KEY:
     logger.warning("OPENWEATHER_API_KEY ikke satt i miljøvariabler")
 
-# HTTP klient
-http_client = httpx.AsyncClient()
+# Faste query-parametre per API. Settes ikke på klienten, siden den deles mellom
+# vertene og API-nøkkelen ikke skal sendes til Nominatim.
+OPENWEATHER_PARAMS = {"appid": OPENWEATHER_API_KEY, "units": "metric", "lang": "no"}
+NOMINATIM_PARAMS = {"format": "json", "limit": 1}
+
+# Tilkoblingspool mot OpenWeather og Nominatim
+HTTP_TIMEOUT = 10.0
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_MAX_CONNECTIONS = 50
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+HTTP_KEEPALIVE_EXPIRY = 30.0
+
+# Nominatim krever en User-Agent som identifiserer applikasjonen
+USER_AGENT = "TravelWeatherAgent/1.0"
+
+# HTTP klient - deles av alle forespørsler slik at TCP/TLS-tilkoblinger gjenbrukes.
+# HTTP/2 lar samtidige kall mot samme vert dele én tilkobling.
+http_client = httpx.AsyncClient(
+    http2=True,
+    headers={"User-Agent": USER_AGENT},
+    timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+)
+
+# Maks samtidige kall per ekstern vert; øvrige kall venter i kø
+MAX_CONCURRENT_PER_HOST = 4
+_host_semaphores: Dict[str, asyncio.Semaphore] = defaultdict(
+    lambda: asyncio.Semaphore(MAX_CONCURRENT_PER_HOST)
+)
+
+# Minste tid mellom kall per vert - Nominatim tillater maks 1 forespørsel i sekundet
+HOST_MIN_INTERVAL = {httpx.URL(NOMINATIM_API_BASE).host: 1.0}
+_host_next_request: Dict[str, float] = {}
+
+# Midlertidige feil prøves på nytt med eksponentiell backoff (0.5, 1, 2s + jitter),
+# eller etter Retry-After hvis serveren oppgir det (begrenset oppad)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+MAX_RETRY_AFTER = 5.0
+
+class TTLCache:
+    """Enkel in-memory cache med TTL og LRU-utkastelse."""
+    
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+    
+    def get(self, key: str) -> Optional[Any]:
+        """Hent verdi, eller None hvis den mangler eller er utløpt."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+    
+    def set(self, key: str, value: Any):
+        """Lagre verdi og kast ut eldste brukte ved behov."""
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+class GeocodeStore:
+    """
+    SQLite-lagring av geokodede koordinater, slik at de overlever omstart.
+    
+    Metodene er blokkerende og kalles via asyncio.to_thread.
+    """
+    
+    def __init__(self, db_path: str, ttl: int):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocode (
+                key TEXT PRIMARY KEY,
+                lat REAL NOT NULL,
+                lon REAL NOT NULL,
+                expires INTEGER NOT NULL
+            )
+        """)
+        # Rydd bort utløpte oppføringer ved oppstart
+        self._conn.execute("DELETE FROM geocode WHERE expires < ?", (int(time.time()),))
+    
+    def get(self, key: str) -> Optional[Dict[str, float]]:
+        """Hent koordinater, eller None hvis de mangler eller er utløpt."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT lat, lon FROM geocode WHERE key = ? AND expires >= ?",
+                (key, int(time.time()))
+            ).fetchone()
+        return {"lat": row[0], "lon": row[1]} if row else None
+    
+    def set(self, key: str, coords: Dict[str, float]):
+        """Lagre koordinater med utløpstid."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO geocode (key, lat, lon, expires) VALUES (?, ?, ?, ?)",
+                (key, coords["lat"], coords["lon"], int(time.time()) + self.ttl)
+            )
+    
+    def close(self):
+        """Lukk databasetilkoblingen."""
+        with self._lock:
+            self._conn.close()
+
+def cache_key(location: str) -> str:
+    """Normaliser stedsnavn slik at "Oslo" og " oslo " deler cache-oppføring."""
+    return location.strip().lower()
+
+# Koordinatene til et sted endrer seg ikke, så geokoding caches lenge
+GEOCODE_CACHE_TTL = 86400
+GEOCODE_CACHE_SIZE = 1024
+geocode_cache = TTLCache(GEOCODE_CACHE_TTL, GEOCODE_CACHE_SIZE)
+# Lås per sted, med antall kall som holder eller venter på den. Låsen fjernes
+# først når ingen bruker den, så alle samtidige kall deler samme lås.
+_geocode_locks: Dict[str, asyncio.Lock] = {}
+_geocode_lock_users: Counter = Counter()
+
+# Geokoding lagres også på disk (volum i docker-compose) og deles på tvers av omstarter
+GEOCODE_DB_PATH = os.getenv("GEOCODE_DB_PATH", "/data/geocode_cache.db")
+GEOCODE_DB_TTL = 30 * 86400
+try:
+    geocode_store: Optional[GeocodeStore] = GeocodeStore(GEOCODE_DB_PATH, GEOCODE_DB_TTL)
+except sqlite3.Error as e:
+    logger.warning(f"Kunne ikke åpne geokodingsdatabase {GEOCODE_DB_PATH}, bruker kun minnecache: {e}")
+    geocode_store = None
+
+# Antall dager i dagsprognosen
+FORECAST_DAYS = 5
+
+# Ferdige værsvar gjenbrukes en kort stund (f.eks. når brukeren spør igjen)
+FORECAST_CACHE_TTL = 60
+FORECAST_CACHE_SIZE = 256
+forecast_cache = TTLCache(FORECAST_CACHE_TTL, FORECAST_CACHE_SIZE)
+_inflight_forecasts: Dict[str, asyncio.Task] = {}
+
+# Batch-kall: maks antall steder per kall og hvor mange som hentes samtidig
+BATCH_MAX_LOCATIONS = 10
+BATCH_CONCURRENCY = 8
+
+# Dagsprognoser per (avrundede koordinater, time)
+DAILY_FORECAST_CACHE_TTL = 3600
+DAILY_FORECAST_CACHE_SIZE = 256
+daily_forecast_cache = TTLCache(DAILY_FORECAST_CACHE_TTL, DAILY_FORECAST_CACHE_SIZE)
+
+# Om API-nøkkelen har tilgang til /forecast/daily; None til første forsøk
+_daily_endpoint_available: Optional[bool] = None
+
+async def _wait_for_rate_limit(host: str):
+    """Vent til neste ledige tidsluke for verter med fast minsteintervall."""
+    interval = HOST_MIN_INTERVAL.get(host)
+    if not interval:
+        return
+    # Luken reserveres før vi venter, så samtidige kall får hver sin luke
+    now = time.monotonic()
+    slot = max(now, _host_next_request.get(host, 0.0))
+    _host_next_request[host] = slot + interval
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+def _retry_delay(response: httpx.Response, attempt: int) -> float:
+    """Ventetid før neste forsøk: Retry-After hvis oppgitt, ellers backoff med jitter."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(float(retry_after), MAX_RETRY_AFTER)
+        except ValueError:
+            pass
+    return RETRY_BACKOFF * 2 ** attempt + random.uniform(0, RETRY_BACKOFF / 2)
+
+async def fetch(url: str, params: Dict[str, Any]) -> httpx.Response:
+    """GET mot ekstern API med tak på samtidige kall, ratebegrensning og nye forsøk per vert."""
+    host = httpx.URL(url).host
+    semaphore = _host_semaphores[host]
+    for attempt in range(MAX_RETRIES + 1):
+        async with semaphore:
+            await _wait_for_rate_limit(host)
+            response = await http_client.get(url, params=params)
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return response
+        
+        # Plassen slippes under ventingen, så andre kall til verten ikke blokkeres
+        delay = _retry_delay(response, attempt)
+        logger.warning("%s svarte %d, prøver igjen om %.1fs", host, response.status_code, delay)
+        await asyncio.sleep(delay)
 
 # Request/Response modeller
 class WeatherRequest(BaseModel):
     location: str
 
-class MCPResponse(BaseModel):
-    success: bool
-    data: Dict[str, Any]
-    timestamp: str
+class BatchWeatherRequest(BaseModel):
+    locations: List[str]
 
 class HealthResponse(BaseModel):
     status: str
     service: str
     timestamp: str
 
-# Startup/shutdown handlers
-@app.on_event("startup")
-async def startup_event():
-    """Initialiser ved oppstart."""
+# Startup/shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialiser ved oppstart og rydd opp ved nedstengning."""
     logger.info("Starting MCP API Server Lab01...")
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Cleanup ved nedstengning."""
+    yield
     await http_client.aclose()
+    if geocode_store is not None:
+        geocode_store.close()
     logger.info("MCP API Server Lab01 avsluttet")
 
+# FastAPI app
+app = FastAPI(
+    title="MCP API Server - Lab02",
+    description="Forenklet HTTP API for workshop med kun værfunksjonalitet",
+    version="1.0.0",
+    lifespan=lifespan,
+    # Svar serialiseres med orjson
+    default_response_class=ORJSONResponse
+)
+
 async def geocode_location(location: str) -> Optional[Dict[str, float]]:
-    """Geocode en lokasjon til koordinater."""
+    """
+    Geocode en lokasjon til koordinater.
+    
+    Vellykkede oppslag caches, og samtidige oppslag av samme sted venter på
+    hverandre slik at bare ett kall går til Nominatim.
+    """
+    key = cache_key(location)
+    cached = geocode_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    lock = _geocode_locks.setdefault(key, asyncio.Lock())
+    _geocode_lock_users[key] += 1
     try:
-        params = {
-            "q": location,
-            "format": "json",
-            "limit": 1,
-            "addressdetails": 1
-        }
+        async with lock:
+            # Et annet kall kan ha fylt cachen mens vi ventet på låsen
+            cached = geocode_cache.get(key)
+            if cached is None and geocode_store is not None:
+                cached = await asyncio.to_thread(geocode_store.get, key)
+                if cached is not None:
+                    geocode_cache.set(key, cached)
+            if cached is None:
+                cached = await _geocode_request(location, key)
+    finally:
+        _geocode_lock_users[key] -= 1
+        if not _geocode_lock_users[key]:
+            del _geocode_lock_users[key]
+            del _geocode_locks[key]
+    
+    return cached
+
+async def _geocode_request(location: str, key: str) -> Optional[Dict[str, float]]:
+    """Slå opp koordinater hos Nominatim og lagre treff i cachen."""
+    try:
+        # Bare koordinatene brukes, så adressedetaljer hentes ikke
+        params = {**NOMINATIM_PARAMS, "q": location}
         
-        response = await http_client.get(f"{NOMINATIM_API_BASE}/search", params=params)
+        response = await fetch(f"{NOMINATIM_API_BASE}/search", params)
         response.raise_for_status()
         
-        data = response.json()
+        data = orjson.loads(response.content)
         if not data:
             return None
             
         result = data[0]
-        return {
+        coords = {
             "lat": float(result["lat"]),
             "lon": float(result["lon"])
         }
         
+        geocode_cache.set(key, coords)
+        if geocode_store is not None:
+            await asyncio.to_thread(geocode_store.set, key, coords)
+        return coords
+        
     except Exception as e:
         logger.error(f"Geocoding error: {e}")
         return None
 
 async def get_weather_forecast(location: str) -> Dict[str, Any]:
-    """Hent værprognose for en destinasjon."""
+    """
+    Hent værprognose for en destinasjon.
+    
+    Vellykkede svar caches kort, og samtidige forespørsler for samme sted
+    deler ett kall mot OpenWeather.
+    """
+    key = cache_key(location)
+    cached = forecast_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    task = _inflight_forecasts.get(key)
+    if task is None:
+        task = asyncio.create_task(_fetch_weather_forecast(location, key))
+        _inflight_forecasts[key] = task
+        task.add_done_callback(lambda _: _inflight_forecasts.pop(key, None))
+    
+    # shield: en avbrutt forespørsel skal ikke avbryte kallet de andre venter på
+    return await asyncio.shield(task)
+
+async def get_weather_forecasts(locations: List[str]) -> Dict[str, Any]:
+    """
+    Hent værprognose for flere destinasjoner i ett kall.
+    
+    Stedene hentes samtidig (begrenset av BATCH_CONCURRENCY) og deler cache
+    og pågående kall med get_weather_forecast. Duplikater hentes én gang.
+    Steder utover BATCH_MAX_LOCATIONS hentes ikke, men får en feilmelding
+    i svaret slik at det er tydelig hvilke som mangler.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def bounded(location: str) -> Dict[str, Any]:
+        async with semaphore:
+            return await get_weather_forecast(location)
+    
+    unique_locations = list(dict.fromkeys(locations))
+    fetched = unique_locations[:BATCH_MAX_LOCATIONS]
+    results = await asyncio.gather(*(bounded(location) for location in fetched))
+    
+    forecasts = dict(zip(fetched, results))
+    skipped = {"error": f"Ikke hentet: maks {BATCH_MAX_LOCATIONS} steder per kall, spør om dette stedet i et nytt kall"}
+    for location in unique_locations[BATCH_MAX_LOCATIONS:]:
+        forecasts[location] = skipped
+    return {"forecasts": forecasts}
+
+async def _fetch_weather_forecast(location: str, key: str) -> Dict[str, Any]:
+    """Geocode lokasjonen og hent værprognose for koordinatene."""
+    if not OPENWEATHER_API_KEY:
+        return {"error": "OpenWeather API-nøkkel mangler"}
+    
+    # Geocode lokasjon
+    coords = await geocode_location(location)
+    if not coords:
+        return {"error": f"Kunne ikke finne lokasjon: {location}"}
+    
+    result = await forecast_by_coords(location, coords)
+    if "error" not in result:
+        forecast_cache.set(key, result)
+    return result
+
+async def forecast_by_coords(name: str, coords: Dict[str, float]) -> Dict[str, Any]:
+    """
+    Hent og formater værprognose fra OpenWeather for kjente koordinater.
+    
+    Kallere som allerede har koordinater slipper et nytt geokodingsoppslag.
+    """
     try:
-        if not OPENWEATHER_API_KEY:
-            return {"error": "OpenWeather API-nøkkel mangler"}
+        # Hent nåværende vær
+        current_params = {**OPENWEATHER_PARAMS, "lat": coords["lat"], "lon": coords["lon"]}
         
-        # Geocode lokasjon
-        coords = await geocode_location(location)
-        if not coords:
-            return {"error": f"Kunne ikke finne lokasjon: {location}"}
+        # Dagsprognosen oppdateres sjelden og gjenbrukes innenfor samme time
+        # for nesten samme koordinater, også når stedet er skrevet ulikt
+        daily_key = f"{round(coords['lat'], 2)}:{round(coords['lon'], 2)}:{int(time.time() // 3600)}"
+        daily = daily_forecast_cache.get(daily_key)
         
-        # Hent nåværende vær
-        current_params = {
-            "lat": coords["lat"],
-            "lon": coords["lon"],
-            "appid": OPENWEATHER_API_KEY,
-            "units": "metric",
-            "lang": "no"
-        }
+        if daily is None:
+            # Nåværende vær og dagsprognose hentes samtidig
+            current_response, daily = await asyncio.gather(
+                fetch(f"{WEATHER_API_BASE}/weather", current_params),
+                fetch_daily_forecast(current_params)
+            )
+            daily_forecast_cache.set(daily_key, daily)
+        else:
+            current_response = await fetch(f"{WEATHER_API_BASE}/weather", current_params)
         
-        current_response = await http_client.get(f"{WEATHER_API_BASE}/weather", params=current_params)
         current_response.raise_for_status()
-        current_data = current_response.json()
-        
-        # Hent 5-dagers prognose
-        forecast_response = await http_client.get(f"{WEATHER_API_BASE}/forecast", params=current_params)
-        forecast_response.raise_for_status()
-        forecast_data = forecast_response.json()
+        current_data = orjson.loads(current_response.content)
         
         # Formater resultat
         result = {
             "location": {
-                "name": location,
+                "name": name,
                 "coordinates": [coords["lat"], coords["lon"]]
             },
             "current": {
@@ -138,47 +433,97 @@ async def get_weather_forecast(location: str) -> Dict[str, Any]:
                 "wind_speed": current_data["wind"]["speed"],
                 "timestamp": datetime.now().isoformat()
             },
-            "forecast": []
+            "forecast": daily
         }
         
-        # Prosesser 5-dagers prognose (gruppér etter dag)
-        daily_forecasts = {}
-        for item in forecast_data["list"]:
-            dt = datetime.fromtimestamp(item["dt"])
-            date_key = dt.strftime("%Y-%m-%d")
-            
-            if date_key not in daily_forecasts:
-                daily_forecasts[date_key] = {
-                    "date": date_key,
-                    "temp_min": item["main"]["temp"],
-                    "temp_max": item["main"]["temp"],
-                    "descriptions": [],
-                    "humidity": item["main"]["humidity"],
-                    "wind_speed": item["wind"]["speed"]
-                }
-            
-            daily_forecasts[date_key]["temp_min"] = min(daily_forecasts[date_key]["temp_min"], item["main"]["temp"])
-            daily_forecasts[date_key]["temp_max"] = max(daily_forecasts[date_key]["temp_max"], item["main"]["temp"])
-            daily_forecasts[date_key]["descriptions"].append(item["weather"][0]["description"])
-        
-        # Formater dagsprognose
-        for date_key in sorted(daily_forecasts.keys())[:5]:
-            day = daily_forecasts[date_key]
-            result["forecast"].append({
-                "date": day["date"],
-                "temp_min": round(day["temp_min"]),
-                "temp_max": round(day["temp_max"]),
-                "description": max(set(day["descriptions"]), key=day["descriptions"].count),
-                "humidity": day["humidity"],
-                "wind_speed": day["wind_speed"]
-            })
-        
         return result
         
     except Exception as e:
         logger.error(f"Weather forecast error: {e}")
         return {"error": f"Kunne ikke hente væropplysninger: {str(e)}"}
 
+async def fetch_daily_forecast(params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Hent dagsprognose for FORECAST_DAYS dager.
+    
+    OpenWeathers dagsendepunkt gir ferdige døgnverdier, men krever et
+    abonnement. Svarer det 401 huskes det, og 3-timersprognosen aggregeres
+    i stedet for resten av prosessens levetid.
+    """
+    global _daily_endpoint_available
+    
+    if _daily_endpoint_available is not False:
+        response = await fetch(f"{WEATHER_API_BASE}/forecast/daily", {**params, "cnt": FORECAST_DAYS})
+        if response.status_code != 401:
+            response.raise_for_status()
+            _daily_endpoint_available = True
+            data = orjson.loads(response.content)
+            # Datoen settes i stedets lokale tid, som i aggregate_forecast
+            tz_offset = data.get("city", {}).get("timezone", 0)
+            return [
+                {
+                    "date": datetime.fromtimestamp(item["dt"] + tz_offset, timezone.utc).strftime("%Y-%m-%d"),
+                    "temp_min": round(item["temp"]["min"]),
+                    "temp_max": round(item["temp"]["max"]),
+                    "description": item["weather"][0]["description"],
+                    "humidity": item["humidity"],
+                    "wind_speed": item["speed"]
+                }
+                for item in data["list"]
+            ]
+        
+        logger.info("OpenWeather-nøkkelen har ikke tilgang til dagsprognose, bruker 3-timersprognose")
+        _daily_endpoint_available = False
+    
+    response = await fetch(f"{WEATHER_API_BASE}/forecast", params)
+    response.raise_for_status()
+    return aggregate_forecast(orjson.loads(response.content))
+
+def aggregate_forecast(forecast_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Slå sammen 3-timersprognosen til dagsprognose (gruppér etter dag)."""
+    daily_forecasts = {}
+    # Dager telles i stedets lokale tid (timezone er UTC-forskyvning i sekunder).
+    # Heltallsnøkkelen gjør at datoen bare formateres én gang per dag.
+    tz_offset = forecast_data.get("city", {}).get("timezone", 0)
+    
+    # Ett pass over listen: min/maks og tellingen av beskrivelser oppdateres løpende
+    for item in forecast_data["list"]:
+        day_index = (item["dt"] + tz_offset) // 86400
+        temp = item["main"]["temp"]
+        
+        day = daily_forecasts.get(day_index)
+        if day is None:
+            # Listen er kronologisk: en ny dato etter FORECAST_DAYS dager betyr at vi er ferdige
+            if len(daily_forecasts) == FORECAST_DAYS:
+                break
+            day = daily_forecasts[day_index] = {
+                "date": datetime.fromtimestamp(day_index * 86400, timezone.utc).strftime("%Y-%m-%d"),
+                "temp_min": temp,
+                "temp_max": temp,
+                "descriptions": Counter(),
+                "humidity": item["main"]["humidity"],
+                "wind_speed": item["wind"]["speed"]
+            }
+        elif temp < day["temp_min"]:
+            day["temp_min"] = temp
+        elif temp > day["temp_max"]:
+            day["temp_max"] = temp
+        
+        day["descriptions"][item["weather"][0]["description"]] += 1
+    
+    # Formater dagsprognose
+    return [
+        {
+            "date": day["date"],
+            "temp_min": round(day["temp_min"]),
+            "temp_max": round(day["temp_max"]),
+            "description": day["descriptions"].most_common(1)[0][0],
+            "humidity": day["humidity"],
+            "wind_speed": day["wind_speed"]
+        }
+        for day in daily_forecasts.values()
+    ]
+
 # API Endpoints
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
@@ -212,6 +557,24 @@ async def list_tools():
             },
             "endpoint": "/weather",
             "method": "POST"
+        },
+        {
+            "name": "get_weather_forecasts",
+            "description": f"Hent værprognose for flere destinasjoner i ett kall (maks {BATCH_MAX_LOCATIONS})",
+            "inputSchema": {
+                "type": "object",
+                "properties": {
+                    "locations": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "maxItems": BATCH_MAX_LOCATIONS,
+                        "description": "Navn på byer eller lokasjoner"
+                    }
+                },
+                "required": ["locations"]
+            },
+            "endpoint": "/weather/batch",
+            "method": "POST"
         }
     ]
     
@@ -220,23 +583,46 @@ async def list_tools():
     }
 
 
-@app.post("/weather", response_model=MCPResponse)
+@app.post("/weather")
 async def get_weather(request: WeatherRequest):
     """Hent værprognose for en destinasjon."""
     try:
-        logger.info(f"Weather request for: {request.location}")
+        logger.debug("Weather request for: %s", request.location)
         result = await get_weather_forecast(request.location)
         
-        return MCPResponse(
-            success=True,
-            data=result,
-            timestamp=datetime.now().isoformat()
-        )
+        # Vanlig dict: værdataene er bygget her og trenger ingen ny validering
+        return {
+            "success": True,
+            "data": result,
+            "timestamp": datetime.now().isoformat()
+        }
         
     except Exception as e:
         logger.error(f"Weather API error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/weather/batch")
+async def get_weather_batch(request: BatchWeatherRequest):
+    """Hent værprognose for flere destinasjoner."""
+    if not request.locations:
+        raise HTTPException(status_code=400, detail="locations kan ikke være tom")
+    
+    try:
+        logger.debug("Batch weather request for: %s", request.locations)
+        result = await get_weather_forecasts(request.locations)
+        
+        return {
+            "success": True,
+            "data": result,
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except Exception as e:
+        logger.error(f"Batch weather API error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 if __name__ == "__main__":
     logger.info("Starting MCP Server API Lab01 on port 8000...")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # "auto" bruker uvloop og httptools når de er installert (uvicorn[standard]),
+    # og faller tilbake til asyncio og h11 der de mangler, f.eks. på Windows
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="auto")
\ No newline at end of file
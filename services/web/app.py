@@ -9,6 +9,7 @@ import asyncio
 import json
 import logging
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Dict, Any
 
@@ -16,7 +17,7 @@ import httpx
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 
@@ -24,19 +25,16 @@ import uvicorn
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# FastAPI app
-app = FastAPI(
-    title="Ingrids Reisetjenester",
-    description="Web grensesnitt for intelligente reisetjenester",
-    version="1.0.0"
+# HTTP klient for agent kall - deles av alle forespørsler slik at
+# tilkoblingene til agent service gjenbrukes. Tilkoblingsfeil prøves én gang til.
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=5.0),
+    limits=httpx.Limits(max_connections=100,
+                        max_keepalive_connections=20,
+                        keepalive_expiry=30.0),
+    transport=httpx.AsyncHTTPTransport(retries=1)
 )
 
-# Templates
-templates = Jinja2Templates(directory="templates")
-
-# HTTP klient for agent kall
-http_client = httpx.AsyncClient()
-
 # Request/Response modeller
 class QueryRequest(BaseModel):
     query: str
@@ -55,18 +53,27 @@ class HealthResponse(BaseModel):
 # Agent service URL
 AGENT_SERVICE_URL = os.getenv("AGENT_SERVICE_URL", "http://travel-agent:8001")
 
-@app.on_event("startup")
-async def startup_event():
-    """Initialiser ved oppstart."""
+# Startup/shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialiser ved oppstart og rydd opp ved nedstengning."""
     logger.info("Starter Ingrids Reisetjenester Web Interface...")
     logger.info(f"Agent service URL: {AGENT_SERVICE_URL}")
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Cleanup ved nedstengning."""
+    yield
     await http_client.aclose()
     logger.info("Web interface avsluttet")
 
+# FastAPI app
+app = FastAPI(
+    title="Ingrids Reisetjenester",
+    description="Web grensesnitt for intelligente reisetjenester",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+# Templates
+templates = Jinja2Templates(directory="templates")
+
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     """Hjem side med web interface."""
@@ -93,7 +100,7 @@ async def health_check():
 async def process_query(query_request: QueryRequest):
     """Prosesser brukerforespørsel via agent service."""
     try:
-        logger.info(f"Sender query til agent service: {query_request.query}")
+        logger.debug("Sender query til agent service: %s", query_request.query)
         
         # Kall agent service
         response = await http_client.post(
@@ -122,6 +129,49 @@ async def process_query(query_request: QueryRequest):
         logger.error(f"Feil ved prosessering: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/query/stream")
+async def process_query_stream(query_request: QueryRequest):
+    """
+    Prosesser brukerforespørsel og videresend agentens svar som Server-Sent Events.
+    
+    Klienter som ikke kan lese en strøm, bruker /query.
+    """
+    request = http_client.build_request(
+        "POST",
+        f"{AGENT_SERVICE_URL}/query/stream",
+        json={"query": query_request.query},
+        # Ingen lesegrense: det kan gå lenge mellom tekstbitene mens agenten kaller verktøy
+        timeout=httpx.Timeout(30.0, read=None)
+    )
+    try:
+        response = await http_client.send(request, stream=True)
+    except httpx.TimeoutException:
+        logger.error("Timeout ved kall til agent service")
+        raise HTTPException(status_code=504, detail="Agent service timeout")
+    except httpx.ConnectError:
+        logger.error("Kan ikke koble til agent service")
+        raise HTTPException(status_code=503, detail="Agent service ikke tilgjengelig")
+    
+    if response.status_code != 200:
+        await response.aclose()
+        logger.error(f"Agent service svarte {response.status_code}")
+        raise HTTPException(status_code=response.status_code, detail="Feil fra agent service")
+    
+    async def relay():
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        except httpx.HTTPError as e:
+            # Strømmen brøt underveis - gi nettleseren beskjed i stedet for å kutte den
+            logger.error(f"Strømmen fra agent service ble avbrutt: {e}")
+            error = json.dumps({"error": "Forbindelsen til agent service ble brutt"})
+            yield f"\n\nevent: error\ndata: {error}\n\n".encode()
+        finally:
+            await response.aclose()
+    
+    return StreamingResponse(relay(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
 @app.get("/examples")
 async def examples():
     """Eksempel forespørsler."""
@@ -162,4 +212,5 @@ async def examples():
 
 if __name__ == "__main__":
     logger.info("Starting Web Interface on port 8080...")
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    # uvloop/httptools når de er installert, ellers asyncio/h11 (se mcp-server)
+    uvicorn.run(app, host="0.0.0.0", port=8080, loop="auto", http="auto")